@@ -2,19 +2,24 @@
 Script designed to take a directory of APS format TXT files provided by the USPTO and convert
 them to a SQLite database.
 
-Note we attempted to parallelize this process, but because SQLite inserts must necessarily be
-performed serially we had minimal performance gains.
+Parsing can be spread across several processes with --workers. Because SQLite inserts must
+necessarily be performed serially, all output is still written by the main process.
 """
 
 import argparse  # Takes command line arguments
 import csv  # Handles CSV output
+import glob  # Expands input path patterns
 import logging  # Handles logging output
+import mmap  # Maps input files into memory
+import os  # Queries file sizes
 import yaml  # Takes input files
 import re  # Regular expressions
 import shutil  # Handles system paths
 import sqlite3  # Handles sqlite
 
-from collections import defaultdict  # Dictionaries that provide default values
+from collections import defaultdict, namedtuple  # Dictionaries that provide default values, light records
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait  # Parses files in parallel
+from itertools import chain, islice  # Iterator helpers
 from pathlib import Path  # Feature-rich path objects
 from pprint import pformat  # Prints data in a nice way
 
@@ -29,14 +34,52 @@ except ImportError:
         """
         return text
 
-# Dictionary of files containing document numbers to ignore
+# Buffer size for CSV output files, so rows reach the disk in large sequential writes
+CSV_BUFFER_SIZE = 1 << 20
+
+# Pre-resolved view of one four-letter section of the config
+HeaderSpec = namedtuple(
+    "HeaderSpec",
+    [
+        "entity", "fields", "literal_map", "regex_any", "regex_list", "match_cache",
+        "actions", "field_index", "patent_id_pos", "template", "filename_pos",
+    ],
+)
+
+# What process_doc does with the value of a line matching a config entry, worked out once per
+# entry. Only the fields relevant to the kind of action are set
+EntryAction = namedtuple("EntryAction", ["kind", "pos", "fieldname", "joiner", "splitter", "constant"])
+ACTION_SET, ACTION_JOIN, ACTION_NEW_RECORD, ACTION_CONSTANT, ACTION_INVALID = range(5)
+
+# Records are lists laid out in their table's column order, and get_fieldnames always puts
+# the id first
+ID_POS = 0
+
+# How much of the next input file to ask the OS to read ahead while the current one is parsed
+PREFETCH_SIZE = 64 << 20
+
+# Default number of buffered records that triggers a write partway through a file
+FLUSH_THRESHOLD = 50000
+
+# Log messages repeated for every file, chunk or table, colored once rather than on each call
+PROCESSING_FILE_MSG = colored("Processing %s...", "green")
+PROCESSING_DOC_MSG = colored("Processing document %d...", "cyan")
+FILE_DONE_MSG = colored("...%d records processed!", "green")
+DEFAULT_JOINER_MSG = colored("No joiner specified for %s, using default.", "yellow")
+WRITING_CSV_MSG = colored("writing csv files to %s ...", "green")
+CSV_EXISTS_MSG = colored("CSV file %s exists; records will be appended.", "yellow")
+WRITING_DB_MSG = colored("Writing records to %s ...", "green")
+WRITING_TABLE_MSG = colored("Writing %d records to `%s`...", "magenta")
+
+# Dictionary of files containing document numbers to ignore. The numbers are kept in sets
+# so filter_records can test each row in constant time
 ENTRIES_TO_IGNORE = {
-    "pftaps19871103_wk44.txt": [
+    "pftaps19871103_wk44.txt": frozenset({
         "047029323",  # These overlap with October 27th
         "047029382",
-    ],
+    }),
 
-    "pftaps19871110_wk45.txt": [
+    "pftaps19871110_wk45.txt": frozenset({
         "H00003670",  # These overlap with November 3rd
         "H00003689",
         "H00003743",
@@ -56,7 +99,7 @@ ENTRIES_TO_IGNORE = {
         "047034491",
         "047034653",
         "047035170",
-    ]
+    }),
 }
 
 
@@ -64,7 +107,10 @@ class PatentTxtToTabular:
     """
     Main object for the conversion. All meaningful computation takes place within this object.
     """
-    def __init__(self, txt_input, config, output_path, output_type, logger, clean, joiner, **kwargs, ):
+    def __init__(
+            self, txt_input, config, output_path, output_type, logger, clean, joiner, workers=1,
+            max_buffer_rows=FLUSH_THRESHOLD, **kwargs,
+    ):
         """
         Initializes the converter
 
@@ -75,6 +121,9 @@ class PatentTxtToTabular:
         logger: Logger object
         clean: Whether to clean the output directory before writing; if not clean, existing files are appended
         joiner: String to join multiple values together
+        workers: Number of processes used to parse TXT files; 1 parses in the main process
+        max_buffer_rows: Number of records buffered before they're written partway through a file; 0
+            writes each file in one go
         """
         # Passes the logger object to the class
         self.logger = logger
@@ -89,9 +138,7 @@ class PatentTxtToTabular:
                 if path.is_file():
                     self.txt_files.append(path)
                 elif path.is_dir():
-                    self.txt_files.extend(
-                        path.glob(f'{"**/" if kwargs["recurse"] else ""}*.[tT][xX][tT]')
-                    )
+                    self.txt_files.extend(find_txt_files(path, kwargs["recurse"]))
                 else:
                     self.logger.fatal("specified input is invalid")
                     exit(1)
@@ -108,34 +155,92 @@ class PatentTxtToTabular:
         # Output to csv or sqlite
         self.output_type = output_type
 
+        # Number of parsing processes
+        self.workers = workers
+
+        # Records held before writing partway through a file
+        self.max_buffer_rows = max_buffer_rows
+
+        # Open file handle and writer for each CSV table, kept for the whole run
+        self._csv_writers = {}
+
         # Import paths from YAML file
-        self.config = yaml.safe_load(open(config))
+        # Use the libyaml-backed loader when PyYAML was built with it
+        with open(config, "rb") as config_file:
+            self.config = yaml.load(config_file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
         self.fieldnames = self.get_fieldnames()
 
+        # Column order of each table as a tuple, shared by the CSV and SQLite writers, and the
+        # position of each column within the records of that table
+        self._columns = {tablename: tuple(columns) for tablename, columns in self.fieldnames.items()}
+        self._field_index = {
+            tablename: {column: pos for pos, column in enumerate(columns)}
+            for tablename, columns in self._columns.items()
+        }
+
+        # Resolve each section of the config once up front, rather than walking the YAML for
+        # every line we parse
+        self._header_table = {
+            header: self.get_header_spec(section) for header, section in self.config.items()
+        }
+        self._pk_head = self.config["PATN"].get("<primary_key>")
+
+        # Headers seen in sections we don't care about, which never match anything
+        self._ignored_matches = {}
+
+        # (entity, fieldname) pairs already reported as falling back to the default joiner
+        self._warned_default_joiner = set()
+
+        # Starting record for each section in the current file, keyed by id of its HeaderSpec
+        self._record_templates = {}
+
         # Tracks primary keys and value tables
         self.init_cache_vars()
 
         # Initialize the database if using SQLite output
         if self.output_type == "sqlite":
-            try:
-                from sqlite_utils import Database as SqliteDB
-                self.db_path = (self.output_path / "db.sqlite").resolve()
-                if self.db_path.exists():
-                    self.logger.warning(
-                        colored(
-                            "Sqlite database %s exists; records will be appended.",
-                            "yellow",
-                        ),
-                        self.db_path,
-                    )
-                db_conn = sqlite3.connect(str(self.db_path), isolation_level=None)
-                db_conn.execute("pragma syncronous=off;")
-                db_conn.execute("pragma journal_mode=memory;")
-                self.db = SqliteDB(db_conn)
-
-            except ImportError:
-                logger.debut("sqlite_utils (pip3 install sqlite-utils) not available")
-                raise
+            self.db_path = (self.output_path / "db.sqlite").resolve()
+            new_db = not self.db_path.exists()
+            if not new_db:
+                self.logger.warning(
+                    colored(
+                        "Sqlite database %s exists; records will be appended.",
+                        "yellow",
+                    ),
+                    self.db_path,
+                )
+            self.db = sqlite3.connect(str(self.db_path), isolation_level=None)
+            # Larger pages mean shallower B-trees for the wide text rows. The page size
+            # can only be chosen before anything is written, so set it first and only
+            # for a fresh database
+            if new_db:
+                self.db.execute("pragma page_size=16384;")
+            # Tune the connection for a single-writer bulk load. A crash while loading a
+            # fresh database means rerunning the conversion anyway, so skip syncing to disk
+            # entirely; when appending, keep enough syncing that a crash can't corrupt the
+            # records loaded by earlier runs
+            for pragma in (
+                    "mmap_size=268435456",
+                    "journal_mode=WAL",
+                    "synchronous=OFF" if new_db else "synchronous=NORMAL",
+                    "temp_store=MEMORY",
+                    "cache_size=-200000",
+                    "locking_mode=EXCLUSIVE",
+            ):
+                self.db.execute(f"pragma {pragma};")
+
+            # Prepared INSERT statements for each table, built on first write
+            self._insert_statements = {}
+
+    def __getstate__(self):
+        """
+        Drops the output state when the converter is sent to a worker process. Workers only
+        parse documents, so they don't need the database connection or any buffered records.
+        """
+        state = self.__dict__.copy()
+        for attr in ("db", "tables", "table_pk_idx", "_csv_writers"):
+            state.pop(attr, None)
+        return state
 
     def init_cache_vars(self):
         """
@@ -144,35 +249,191 @@ class PatentTxtToTabular:
         self.tables = defaultdict(list)
         self.table_pk_idx = defaultdict(lambda: defaultdict(int))
 
-    def yield_txt_doc(self, filepath):
+    def get_header_spec(self, section):
         """
-        Given a TXT file path, this iterates through the results and yields all data for a single patent document--
-        i.e., it splits the file based on "PATN" headers. Each line within the document is stored as a string
-        in the yielded list
+        Given the config for a four-letter section, pre-resolves everything process_doc needs to
+        know about it into a HeaderSpec
         """
-        # List for storing text
-        txt_doc = []
+        subconfig = section['<fields>']
+        literal_map, regex_any, regex_list = self._compile_subconfig(subconfig)
+        entity = section['<entity>']
+        field_index = self._field_index[entity]
+
+        # Constant fields are the same for every record, so build them once. Fields a record
+        # never sees stay None, which the writers output as empty strings or NULLs
+        template = [None] * len(field_index)
+        if "<constant>" in subconfig:
+            for variable in subconfig["<constant>"]:
+                template[field_index[variable["<fieldname>"]]] = variable["<enum_type>"]
+
+        filename_field = subconfig.get("<filename_field>")
+
+        actions = {
+            entry: self.get_entry_action(value, field_index)
+            for entry, value in subconfig.items()
+            if not entry.startswith("<")
+        }
+
+        return HeaderSpec(
+            entity=entity,
+            fields=subconfig,
+            literal_map=literal_map,
+            regex_any=regex_any,
+            regex_list=regex_list,
+            # Filled in by process_doc; there are only so many distinct headers, so each
+            # one only has to be matched against the config once
+            match_cache={},
+            actions=actions,
+            field_index=field_index,
+            # The patent table is the parent, so it has no link back to a patent
+            patent_id_pos=field_index.get("patent_id"),
+            template=template,
+            filename_pos=field_index[filename_field] if filename_field else None,
+        )
 
-        # Opens lines from file
-        with open(filepath, "r", encoding="ISO-8859-1") as _fh:
+    def get_entry_action(self, value, field_index):
+        """
+        Given the config value of a single entry, pre-resolves how process_doc should store the
+        values of matching lines into an EntryAction
+        """
+        # If the value is simply the fieldname, it's one-to-one, with repeats joined using the
+        # default joiner
+        if isinstance(value, str):
+            return EntryAction(ACTION_SET, field_index[value], value, self.default_joiner, None, None)
+
+        # If the value is parameterized, repeats are handled by its joiner, and it may say
+        # which headers start a new record
+        if "<fieldname>" in value:
+            joiner = value.get("<joiner>", self.default_joiner)
+            splitter = re.compile(value["<splitter>"]) if value.get("<splitter>") else None
+            return EntryAction(
+                ACTION_NEW_RECORD if joiner == "<new_record>" else ACTION_JOIN,
+                field_index[value["<fieldname>"]],
+                value["<fieldname>"],
+                joiner,
+                splitter,
+                None,
+            )
 
-            # Skip first line of header information
-            next(_fh)
+        if "<constant>" in value:
+            constant = value["<constant>"]
+            return EntryAction(
+                ACTION_CONSTANT, field_index[constant["<fieldname>"]], None, None, None, constant["<enum_type>"]
+            )
 
-            # Splits file at each PATN line
-            for i, line in enumerate(_fh):
-                # When you get to the next patent, yield the current results
-                # and restart
-                if line.startswith("PATN"):
-                    if txt_doc:
-                        yield i - len(txt_doc), "".join(txt_doc)
-                    txt_doc = []
+        # Only an error if a line actually matches the entry
+        return EntryAction(ACTION_INVALID, None, None, None, None, None)
 
-                # Add line to current document
-                txt_doc.append(line)
+    @staticmethod
+    def _compile_subconfig(subconfig):
+        """
+        Splits the entries of a subconfig into literal headers, which can be found with a plain
+        dictionary lookup, and true regular expressions, which are compiled once.
+
+        Returns a tuple (literal_map, regex_any, regex_list). literal_map is keyed by header and
+        regex_list holds compiled patterns; both carry the entry's position so config order can be
+        kept. regex_any is a single alternation of every pattern in regex_list, so one match tells
+        us whether any of them can apply. It's None when there's no safe way to combine them, in
+        which case every pattern is tried.
+        """
+        literal_map = {}
+        regex_list = []
+        for position, entry in enumerate(subconfig):
+            # Keys like <constant> describe the record rather than an APS header
+            if entry.startswith("<"):
+                continue
+
+            # re.match only anchors at the start of the header, so a literal is only
+            # equivalent to an exact lookup if it's at least as long as a field header
+            if re.escape(entry) == entry and len(entry) >= 3:
+                literal_map[entry] = (position, entry)
+            else:
+                regex_list.append((re.compile(entry), (position, entry)))
+
+        # Joining patterns only means the same thing as trying them one by one if none of them
+        # has groups (which could clash or renumber backreferences) or inline flags (which
+        # must come first in a pattern)
+        regex_any = None
+        if regex_list and all(
+                pattern.groups == 0 and pattern.flags == re.UNICODE for pattern, _ in regex_list
+        ):
+            try:
+                regex_any = re.compile("|".join(f"(?:{pattern.pattern})" for pattern, _ in regex_list))
+            except re.error:
+                regex_any = None
+
+        return literal_map, regex_any, regex_list
+
+    @staticmethod
+    def _match_entries(literal_map, regex_any, regex_list, header):
+        """
+        Returns the subconfig entries matching a header, in the order they appear in the config
+        """
+        literal = literal_map.get(header)
+        if not regex_list or (regex_any is not None and not regex_any.match(header)):
+            return [literal[1]] if literal else []
 
-            # Make sure you yield the final document!
-            yield i - len(txt_doc), "".join(txt_doc)
+        matches = [info for pattern, info in regex_list if pattern.match(header)]
+        if literal:
+            matches.append(literal)
+            matches.sort()
+
+        return [entry for _, entry in matches]
+
+    def yield_txt_doc(self, filepath):
+        """
+        Given a TXT file path, this iterates through the results and yields all data for a single patent document--
+        i.e., it splits the file based on "PATN" headers. Along with the index of the document's first line, each
+        line within the document is stored as a string (without its line ending) in the yielded list
+        """
+        # Memory-map the raw bytes rather than reading the whole file in; document boundaries
+        # are found with find, which runs in C, and each document is decoded in one go rather
+        # than line by line. Empty files can't be mapped and have no documents anyway
+        with open(filepath, "rb") as _fh:
+            if not os.fstat(_fh.fileno()).st_size:
+                return
+            with mmap.mmap(_fh.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                yield from self._split_txt_docs(data, view)
+
+    @staticmethod
+    def _split_txt_docs(data, view):
+        """
+        Does the work of yield_txt_doc over the mapped file data, with view a memoryview of it
+        """
+        # Lines normally end in "\n" (or "\r\n"), but files with bare "\r" line endings
+        # have no "\n" at all, so their documents are found by "\r" instead
+        newline = b"\n"
+        start = data.find(newline) + 1
+        if not start:
+            newline = b"\r"
+            start = data.find(newline) + 1
+
+        # Skip first line of header information
+        if not start:
+            return
+        boundary = newline + b"PATN"
+
+        linenum = 0
+        size = len(data)
+        while start < size:
+            # Each document runs up to and including the newline before the next PATN line
+            end = data.find(boundary, start) + 1 or size
+
+            # Decode straight from the map without copying the bytes first, and
+            # normalize line endings the way text mode would
+            text = str(view[start:end], "ISO-8859-1")
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+            # Splitting leaves an empty string after the final newline
+            txt_doc = text.split("\n")
+            if text.endswith("\n"):
+                txt_doc.pop()
+
+            yield linenum, txt_doc
+
+            linenum += len(txt_doc)
+            start = end
 
     def convert(self):
         """
@@ -182,26 +443,97 @@ class PatentTxtToTabular:
         if not self.txt_files:
             self.logger.warning(colored("No input files to prcoess!", "red", ))
 
-        # Process each input file
-        for input_file in self.txt_files:
+        try:
+            # Parse the files in worker processes if requested. Each worker gets its copy
+            # of the converter once when it starts rather than with every file. Results
+            # are written as soon as any file finishes, and only a couple of files per
+            # worker are in flight at once, so finished files don't pile up in memory
+            # behind a slow one
+            if self.workers > 1:
+                with ProcessPoolExecutor(
+                        max_workers=self.workers, initializer=init_worker, initargs=(self,)
+                ) as pool:
+                    remaining = iter(self.txt_files)
+                    pending = {
+                        pool.submit(parse_file, input_file)
+                        for input_file in islice(remaining, 2 * self.workers)
+                    }
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self.write_results(future.result())
+                            for input_file in islice(remaining, 1):
+                                pending.add(pool.submit(parse_file, input_file))
+
+            # Otherwise, write each chunk as soon as it has been parsed so at most
+            # max_buffer_rows records are held in memory. While a file is parsed, the
+            # OS reads the next one in the background
+            else:
+                for pos, input_file in enumerate(self.txt_files):
+                    if pos + 1 < len(self.txt_files):
+                        prefetch_file(self.txt_files[pos + 1])
+                    self.write_results(self.parse_file(input_file, self.max_buffer_rows))
 
-            self.logger.info(colored("Processing %s...", "green"), input_file.resolve())
-            self.current_filename = input_file.resolve().name
+        finally:
+            self.close_csv_files()
 
-            for i, (linenum, doc) in enumerate(self.yield_txt_doc(input_file)):
-                if i % 100 == 0:
-                    self.logger.debug(
-                        colored("Processing document %d...", "cyan"), i + 1
-                    )
+        self.logger.info(colored("Parsing complete!", "green"))
+
+    def parse_file(self, input_file, flush_threshold=None):
+        """
+        Parses every document in a single TXT file, yielding the name of the file along with the
+        records found for each table. If flush_threshold is given, the records are yielded in
+        chunks whenever that many have been buffered, rather than once at the end of the file.
+        """
+        input_path = input_file.resolve()
+        self.logger.info(PROCESSING_FILE_MSG, input_path)
+        self.current_filename = input_path.name
+
+        # Starting records include the filename, so they need rebuilding for each file
+        self._record_templates = {}
+
+        # Start from an empty set of tables for each file
+        self.init_cache_vars()
+
+        # The logging level doesn't change partway through a file, so only check it once
+        debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
+        process_doc = self.process_doc
+
+        # Files without any documents never enter the loop
+        i = -1
+        for i, (linenum, doc) in enumerate(self.yield_txt_doc(input_file)):
+            if debug_enabled and i % 100 == 0:
+                self.logger.debug(PROCESSING_DOC_MSG, i + 1)
+
+            process_doc(doc)
+
+            # Hand off what we have so far if the buffer is getting large
+            if flush_threshold and sum(map(len, self.tables.values())) >= flush_threshold:
+                yield self.current_filename, self.tables
+                self.init_cache_vars()
 
-                self.process_doc(doc)
+        self.logger.info(FILE_DONE_MSG, i + 1)
 
-            self.logger.info(colored("...%d records processed!", "green"), i + 1)
+        yield self.current_filename, self.tables
 
-            # Write the output to CSV or SQLite after each file
+    def write_results(self, chunks):
+        """
+        Given the parsed output of a single input file, writes each chunk of records to CSV or
+        SQLite. For SQLite, the whole file is written in one transaction.
+        """
+        if self.output_type == "sqlite":
+            self.db.execute("begin exclusive;")
+
+        for filename, tables in chunks:
+            # ENTRIES_TO_IGNORE is keyed by the file the records came from
+            self.current_filename = filename
+            self.tables = tables
+
+            # Write the output to CSV or SQLite
             self.flush_to_disk()
 
-        self.logger.info(colored("Parsing complete!", "green"))
+        if self.output_type == "sqlite":
+            self.db.execute("commit;")
 
     def flush_to_disk(self):
         """
@@ -224,7 +556,8 @@ class PatentTxtToTabular:
         four-letter APS headers, the inner dictionary is keyed by three-letter
         APS subheaders, and the values are the name of the field in the database.
         """
-        fieldnames = defaultdict(list)
+        # Each entity's fields are kept as the keys of a dict, which works as an ordered set
+        fieldnames = defaultdict(dict)
 
         def add_fieldnames(config, _fieldnames, parent_entity=None):
             """
@@ -257,11 +590,9 @@ class PatentTxtToTabular:
                 for subconfig in config["<fields>"].values():
                     add_fieldnames(subconfig, _fieldnames, entity)
 
-                # Since different paths may go to same table, append to
-                # list of fieldnames here.
-                fieldnames[entity] = list(
-                    dict.fromkeys(fieldnames[entity] + _fieldnames).keys()
-                )
+                # Since different paths may go to same table, add any new
+                # fieldnames to the ones found so far.
+                fieldnames[entity].update(dict.fromkeys(_fieldnames))
                 return
 
             if isinstance(config, list):
@@ -279,238 +610,296 @@ class PatentTxtToTabular:
             add_fieldnames(config, [])
 
         for entity in fieldnames:
+            fieldnames[entity] = list(fieldnames[entity])
             if entity != "patent":
                 fieldnames[entity] = ["patent_id"] + fieldnames[entity]
             fieldnames[entity] = ["id"] + fieldnames[entity]
 
         return fieldnames
 
-    def new_record(self, subconfig):
+    def new_record(self, spec):
         """
-        Generates a new record object based on the parameters in subconfig
+        Generates a new record object based on the section described by spec
         """
-        # Generate a new record
-        record = {}
+        template = self._record_templates.get(id(spec))
 
-        # If there is at least one constant field
-        if "<constant>" in subconfig:
+        # The first record of a section in each file works out the starting values
+        if template is None:
+            # Start from the section's constant fields
+            template = spec.template.copy()
 
-            # Add each constant field to the record
-            for variable in subconfig["<constant>"]:
-                fieldname = variable["<fieldname>"]
-                value = variable["<enum_type>"]
-                record[fieldname] = value
+            # If we want to save the filename, save it now
+            if spec.filename_pos is not None:
+                template[spec.filename_pos] = self.current_filename
 
-        # If we want to save the filename, save it now
-        if "<filename_field>" in subconfig:
-            fieldname = subconfig["<filename_field>"]
-            record[fieldname] = self.current_filename
+            self._record_templates[id(spec)] = template
 
+        return template.copy()
+
+    @staticmethod
+    def _append_part(record, parts, pos, separator, value):
+        """
+        Adds separator and value onto the field at pos, which already has a value. The pieces are
+        kept in parts and only joined when the record is finished, so long multi-line fields
+        aren't copied again on every line.
+        """
+        pieces = parts.get(pos)
+        if pieces is None:
+            parts[pos] = [record[pos], separator, value]
+        else:
+            pieces.append(separator)
+            pieces.append(value)
+
+    @staticmethod
+    def _join_parts(record, parts):
+        """
+        Joins any pieces accumulated by _append_part into their fields and clears parts. Returns
+        the finished record.
+        """
+        for pos, pieces in parts.items():
+            record[pos] = "".join(pieces)
+        parts.clear()
         return record
 
     def process_doc(self, txt_doc):
-        """The method for actually reading the contents of the CSV files"""
+        """
+        The method for actually reading the contents of the TXT files. txt_doc is the list of lines
+        making up a single patent, as yielded by yield_txt_doc.
+        """
+        # Bind the attributes used on every line to locals; this loop runs once
+        # per line of the corpus, so attribute lookups add up
+        header_table = self._header_table
+        tables = self.tables
+        match_entries = self._match_entries
+        append_part = self._append_part
+        join_parts = self._join_parts
+        new_record = self.new_record
+        warned_default_joiner = self._warned_default_joiner
+
         # Initialize with PATN since we know first section of document will
         # be a patent.
         header = "PATN"
-        last_header = header
-        current_entity = self.config[header]['<entity>']
-        subconfig = self.config[header]['<fields>']
+        spec = header_table[header]
+        current_entity = spec.entity
+        subconfig = spec.fields
+        literal_map, regex_any, regex_list = spec.literal_map, spec.regex_any, spec.regex_list
+        match_cache = spec.match_cache
+        actions = spec.actions
+        patent_id_pos = spec.patent_id_pos
         splitter = None
         patent_pk = None
+        # Child ids are built from the primary key as a string, which only changes once
+        patent_pk_str = str(patent_pk)
         pk_counter = 0
-        record = self.new_record(subconfig)
+        record = new_record(spec)
+        pk_head = self._pk_head
+
+        # Whether a headerless line continues the fields of the last header line.
+        # This only changes when a header line is seen, so it's worked out there
+        # rather than re-matching the last header on every continuation line
+        continues = False
 
-        if "<primary_key>" in self.config[header]:
-            pk_head = self.config[header]["<primary_key>"]
+        # Pieces of fields built up over several lines, joined once the record is finished
+        parts = {}
 
         # Go through each line of the file
-        # Need to skip first two lines since they contain metadata
-        # and we don't want to write an empty patent record
-        for line in txt_doc.split('\n')[1:]:
+        # Need to skip the PATN line since we've already started the patent
+        # record and don't want to write an empty one
+        for line in islice(txt_doc, 1, None):
 
             # Get the first four characters to see if we're in a new logical unit
             header = line[0:4].strip()
 
-            # Keeps track of the last known header for evaluating whether multi-line
-            # statements are relevant
-            if header:
-                last_header = header
-
             if header == pk_head:
                 # Primary keys must be unique
-                assert "id" not in record
-                record["id"] = line[4:].strip()
-                patent_pk = record["id"]
+                assert record[ID_POS] is None
+                patent_pk = patent_pk_str = record[ID_POS] = line[4:].strip()
 
             if len(header) == 4:
                 # Change the header and current config if so
                 # If we care about the new section, write what we've found to a file
                 # and fetch the new subsections
-                if header in self.config:
-                    self.tables[current_entity].append(record)
-                    current_entity = self.config[header]['<entity>']
-                    subconfig = self.config[header]['<fields>']
-                    record = self.new_record(subconfig)
-
-                    record["id"] = str(patent_pk) + '_' + str(pk_counter)
-                    record["patent_id"] = patent_pk
+                if header in header_table:
+                    tables[current_entity].append(join_parts(record, parts))
+                    spec = header_table[header]
+                    current_entity = spec.entity
+                    subconfig = spec.fields
+                    literal_map, regex_any, regex_list = spec.literal_map, spec.regex_any, spec.regex_list
+                    match_cache = spec.match_cache
+                    actions = spec.actions
+                    patent_id_pos = spec.patent_id_pos
+                    record = new_record(spec)
+
+                    record[ID_POS] = f"{patent_pk_str}_{pk_counter}"
+                    if patent_id_pos is not None:
+                        record[patent_id_pos] = patent_pk
                     pk_counter += 1
 
                     # Since headers don't cross entities, any starting blank lines
                     # shouldn't be appended to the previous record
-                    last_header = ""
+                    continues = False
 
                 # If we don't care about the new section, just say it has no relevant
                 # fields and continue. Don't create a new record or write yet, since that
                 # will create empty lines for the null section
                 else:
                     subconfig = {}
+                    literal_map, regex_any, regex_list = {}, None, []
+                    match_cache = self._ignored_matches
+                    continues = False
 
             # If there's no header but we're in a meaningful subconfig, we're continuing the
             # same script as the previous line. Just keep appending.
-            elif not header and any(re.match(entry, last_header) for entry in subconfig):
-                # Fieldname must have been previously defined if last_header in subconfig
+            elif not header and continues:
+                # Fields must have been previously defined if the last header matched
                 # Append it for each field where that header was relevant
-                for fieldname in fieldnames:
-                    record[fieldname] = record[fieldname] + ' ' + line[4:].strip()
+                value = line[4:].strip()
+                for pos in positions:
+                    append_part(record, parts, pos, ' ', value)
             else:
-                # List for holding names if data goes in multiple fields
-                fieldnames = []
-
-                for entry in subconfig:
-                    # If the config file entry matches the file header,
-                    # pull the fieldname from the YAML file
-                    if re.match(entry, header):
-                        # Get the text to store
-                        value = line[4:].strip()
-
-                        # If the value is simply the fieldname, it's one-to-one
-                        # and we can just save the value
-                        if isinstance(subconfig[entry], str):
-                            fieldname = subconfig[entry]
-                            fieldnames.append(fieldname)
-                            if fieldname in record:
-                                self.logger.debug(
-                                    colored("No joiner specified for %s, using default.", "yellow"),
-                                    fieldname
-                                )
-                                record[fieldname] = record[fieldname] + self.default_joiner + value
-                            else:
-                                record[fieldname] = value
+                # List for holding field positions if data goes in multiple fields
+                positions = []
+
+                # Find the actions of the config file entries matching the file header
+                matches = match_cache.get(header)
+                if matches is None:
+                    matches = match_cache[header] = tuple(
+                        actions[entry] for entry in match_entries(literal_map, regex_any, regex_list, header)
+                    )
 
-                        # If the value is parameterized, we need to handle
-                        # many-to-one issues
-                        elif "<fieldname>" in subconfig[entry]:
-                            # First, save the fieldname
-                            fieldname = subconfig[entry]["<fieldname>"]
-                            fieldnames.append(fieldname)
+                # Blank headers fall through here when there's nothing to continue, and
+                # shouldn't change whether later blank lines continue either
+                if header:
+                    continues = bool(matches)
 
-                            if "<splitter>" in subconfig[entry]:
-                                splitter = subconfig[entry]["<splitter>"]
-                            else:
-                                splitter = None
-
-                            # If we've seen one before, add the new one with a delimiter
-                            if fieldname in record:
-                                # Pulls the joiner if there is one, otherwise uses default
-                                if "<joiner>" in subconfig[entry]:
-                                    joiner = subconfig[entry]["<joiner>"]
-                                else:
-                                    joiner = self.default_joiner
-
-                                # If new occurances get their own row
-                                if joiner == "<new_record>":
-
-                                    # Write the previous record to the file
-                                    self.tables[current_entity].append(record)
-
-                                    # Generate a new record with keys
-                                    record = self.new_record(subconfig)
-                                    record["id"] = str(patent_pk) + '_' + str(pk_counter)
-                                    record["patent_id"] = str(patent_pk)
-                                    pk_counter += 1
-
-                                    # Record the new value
-                                    record[fieldname] = value
-
-                                # If we're using a text joiner
-                                else:
-                                    record[fieldname] = record[fieldname] + joiner + value
-                            # Otherwise, just save the value for now
-                            else:
-                                record[fieldname] = value
-
-                        elif "<constant>" in subconfig[entry]:
-                            # NOTE: MAD HACKY CODE HERE
-                            # This should reasonably have a line
-                            # fieldname = subconfig[entry]["<constant>"]["<fieldname>"]
-                            # and then just set the record for fieldname
-                            # However, the way we continue appending in the case of headerless
-                            # rows depends on maintaining the previous fieldname, which we don't
-                            # want to do to constant fields. Therefore, we don't use fieldname here
-                            value = subconfig[entry]["<constant>"]["<enum_type>"]
-                            record[subconfig[entry]["<constant>"]["<fieldname>"]] = value
+                # If we've hit the splitter, start a new record before applying this line's
+                # values, at most once per line and whether or not an entry also matches the
+                # header. Ignored sections never split
+                if splitter and subconfig and splitter.match(header):
+                    tables[current_entity].append(join_parts(record, parts))
+
+                    record = new_record(spec)
+
+                    record[ID_POS] = f"{patent_pk_str}_{pk_counter}"
+                    if patent_id_pos is not None:
+                        record[patent_id_pos] = patent_pk
+                    pk_counter += 1
 
+                for kind, pos, fieldname, joiner, entry_splitter, constant in matches:
+                    # Get the text to store
+                    value = line[4:].strip()
+
+                    # If the value is simply the fieldname, it's one-to-one
+                    # and we can just save the value
+                    if kind == ACTION_SET:
+                        positions.append(pos)
+                        if record[pos] is not None:
+                            # Only say so the first time, rather than for every repeat
+                            if (current_entity, fieldname) not in warned_default_joiner:
+                                warned_default_joiner.add((current_entity, fieldname))
+                                self.logger.debug(DEFAULT_JOINER_MSG, fieldname)
+                            append_part(record, parts, pos, joiner, value)
                         else:
-                            print("ERROR: Fields must be string or contain <fieldname> or <constant>")
-                            raise LookupError
-                    elif splitter:
-                        if re.match(splitter, header):
-                            self.tables[current_entity].append(record)
+                            record[pos] = value
 
-                            record = self.new_record(subconfig)
+                    # If the value is parameterized, we need to handle
+                    # many-to-one issues
+                    elif kind == ACTION_JOIN or kind == ACTION_NEW_RECORD:
+                        positions.append(pos)
+                        splitter = entry_splitter
 
-                            record["id"] = str(patent_pk) + '_' + str(pk_counter)
-                            record["patent_id"] = patent_pk
-                            pk_counter += 1
+                        # If we've seen one before, add the new one with a delimiter
+                        if record[pos] is not None:
+                            # If new occurances get their own row
+                            if kind == ACTION_NEW_RECORD:
+
+                                # Write the previous record to the file
+                                tables[current_entity].append(join_parts(record, parts))
+
+                                # Generate a new record with keys
+                                record = new_record(spec)
+                                record[ID_POS] = f"{patent_pk_str}_{pk_counter}"
+                                if patent_id_pos is not None:
+                                    record[patent_id_pos] = patent_pk_str
+                                pk_counter += 1
+
+                                # Record the new value
+                                record[pos] = value
+
+                            # If we're using a text joiner
+                            else:
+                                append_part(record, parts, pos, joiner, value)
+                        # Otherwise, just save the value for now
+                        else:
+                            record[pos] = value
+
+                    elif kind == ACTION_CONSTANT:
+                        # Constant fields aren't added to positions, since headerless rows
+                        # continuing this line shouldn't be appended to them
+                        record[pos] = constant
+
+                    else:
+                        print("ERROR: Fields must be string or contain <fieldname> or <constant>")
+                        raise LookupError
 
         # Add to list of those entities found so far
-        self.tables[current_entity].append(record)
+        tables[current_entity].append(join_parts(record, parts))
 
     def write_csv_files(self):
         """
         Given the parsed results stored in self.tables, write the results to the CSV files
         """
-        self.logger.info(
-            colored("writing csv files to %s ...", "green"), self.output_path.resolve()
-        )
+        self.logger.info(WRITING_CSV_MSG, self.output_path.resolve())
 
         for tablename, rows in self.tables.items():
+            records_to_add = self.filter_records(tablename, rows)
+
+            # Records are already in column order; fields a record never saw are None, which
+            # csv writes as empty strings
+            self.get_csv_writer(tablename).writerows(records_to_add)
+
+    def get_csv_writer(self, tablename):
+        """
+        Returns the CSV writer for a table. The first time a table is written to in a run, its
+        file is opened (writing the header if the file is new) and kept open until
+        close_csv_files is called.
+        """
+        if tablename not in self._csv_writers:
             output_file = self.output_path / f"{tablename}.csv"
 
-            records_to_add = self.filter_records(tablename, rows)
-            
             if output_file.exists():
                 self.logger.debug(
-                    colored("CSV file %s exists; records will be appended.", "yellow"),
+                    CSV_EXISTS_MSG,
                     output_file
                 )
-
-                with output_file.open("a", newline='') as _fh:
-                    writer = csv.DictWriter(_fh, fieldnames=self.fieldnames[tablename])
-                    writer.writerows(records_to_add)
+                _fh = output_file.open("a", newline='', encoding="utf-8", buffering=CSV_BUFFER_SIZE)
+                writer = csv.writer(_fh)
 
             else:
-                with output_file.open("w", newline='') as _fh:
-                    writer = csv.DictWriter(_fh, fieldnames=self.fieldnames[tablename])
-                    writer.writeheader()
-                    writer.writerows(records_to_add)
+                _fh = output_file.open("w", newline='', encoding="utf-8", buffering=CSV_BUFFER_SIZE)
+                writer = csv.writer(_fh)
+                writer.writerow(self._columns[tablename])
+
+            self._csv_writers[tablename] = (_fh, writer)
+
+        return self._csv_writers[tablename][1]
+
+    def close_csv_files(self):
+        """
+        Closes every CSV file opened by get_csv_writer
+        """
+        for _fh, _writer in self._csv_writers.values():
+            _fh.close()
+        self._csv_writers = {}
 
     def write_sqlitedb(self):
         """
         Given the results stored in self.tables, write the results to db.sqlite
         """
-        self.logger.info(
-            colored("Writing records to %s ...", "green"), self.db_path,
-        )
-        self.db.conn.execute("begin exclusive;")
+        self.logger.info(WRITING_DB_MSG, self.db_path)
         for tablename, rows in self.tables.items():
-            params = {"column_order": self.fieldnames[tablename], "alter": True}
-            if "id" in self.fieldnames[tablename]:
-                params["not_null"] = {"id"}
             self.logger.debug(
-                colored("Writing %d records to `%s`...", "magenta"),
+                WRITING_TABLE_MSG,
                 len(rows),
                 tablename,
             )
@@ -518,9 +907,39 @@ class PatentTxtToTabular:
             # Ignore ENTRIES_TO_IGNORE
             records_to_add = self.filter_records(tablename, rows)
 
-            # For some reason we need to really limit the batch size
-            # or else you end up running into SQL variable limits somehow?
-            self.db[tablename].insert_all(records_to_add, batch_size=20, **params)
+            # Bind every row to the same prepared statement in one call
+            self.db.executemany(self.get_insert_statement(tablename), records_to_add)
+
+    def get_insert_statement(self, tablename):
+        """
+        Returns the INSERT statement for a table, which takes values in the table's column
+        order, as records are laid out. The first time a table is written to, it's created if needed and any
+        columns it's missing are added.
+        """
+        if tablename not in self._insert_statements:
+            columns = self._columns[tablename]
+            existing = [
+                column_info[1] for column_info in self.db.execute(f"pragma table_info([{tablename}]);")
+            ]
+
+            # All values are text; id is required since it links the tables together
+            definitions = [
+                f"[{column}] TEXT NOT NULL" if column == "id" else f"[{column}] TEXT"
+                for column in columns
+            ]
+            if not existing:
+                self.db.execute(f"CREATE TABLE [{tablename}] ({', '.join(definitions)});")
+            else:
+                for column in columns:
+                    if column not in existing:
+                        self.db.execute(f"ALTER TABLE [{tablename}] ADD COLUMN [{column}] TEXT;")
+
+            self._insert_statements[tablename] = (
+                f"INSERT INTO [{tablename}] ({', '.join(f'[{column}]' for column in columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})"
+            )
+
+        return self._insert_statements[tablename]
 
     def filter_records(self, tablename, rows):
         """
@@ -530,21 +949,17 @@ class PatentTxtToTabular:
         # We want to ignore some records that are in the data by mistake
         # First, check if the current file contains any ignored entries
         if self.current_filename in ENTRIES_TO_IGNORE:
-            # Get the list of entries to ignore
+            # Get the set of entries to ignore
             docs_to_ignore = ENTRIES_TO_IGNORE[self.current_filename]
 
-            # Create list of records to include in output
-            records_to_add = []
-
-            # Check if each row should be included
-            for row in rows:
-                # If it's a child document and we care about the parent, append it
-                if "patent_id" in row and row["patent_id"] not in docs_to_ignore:
-                    records_to_add.append(row)
+            # If it's the main patent entry and we care about it, keep it
+            if tablename == "patent":
+                records_to_add = [row for row in rows if row[ID_POS] not in docs_to_ignore]
 
-                # If it's the main patent entry and we care about it, append it
-                elif tablename == "patent" and row["id"] not in docs_to_ignore:
-                    records_to_add.append(row)
+            # If it's a child document and we care about the parent, keep it
+            else:
+                patent_id_pos = self._field_index[tablename]["patent_id"]
+                records_to_add = [row for row in rows if row[patent_id_pos] not in docs_to_ignore]
 
         # If we care about all records in the file, just add all the rows
         else:
@@ -553,14 +968,100 @@ class PatentTxtToTabular:
         return records_to_add
     
 
+# The converter used by a worker process, set up by init_worker
+_worker_converter = None
+
+
+def init_worker(converter):
+    """
+    Stores the converter for the lifetime of a worker process
+    """
+    global _worker_converter
+    _worker_converter = converter
+
+
+def parse_file(input_file):
+    """
+    Module-level wrapper around PatentTxtToTabular.parse_file so worker processes can
+    receive it
+    """
+    return list(_worker_converter.parse_file(input_file))
+
+
+def prefetch_file(path):
+    """
+    Asks the OS to start reading the beginning of a file into the page cache, so it's ready by
+    the time it's parsed; the kernel's own readahead takes over from there. This is only a hint,
+    so it does nothing on platforms without posix_fadvise or if the file can't be opened--any
+    real problem with the file is reported when it's parsed.
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            with open(path, "rb") as _fh:
+                os.posix_fadvise(_fh.fileno(), 0, PREFETCH_SIZE, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+def find_txt_files(directory, recurse=False):
+    """
+    Yields the paths of the TXT files (with any capitalization of the extension) in a directory,
+    and in its subdirectories if recurse is set. Walks the tree with os.scandir, so only the
+    matching files get Path objects.
+    """
+    # Symlinked directories are followed, as Path.glob did; each directory is searched only
+    # once, so links back up the tree don't loop forever
+    stack = [str(directory)]
+    visited = set()
+    while stack:
+        path = stack.pop()
+        stat = os.stat(path)
+        if (stat.st_dev, stat.st_ino) in visited:
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(".txt") and entry.is_file():
+                    yield Path(entry.path)
+                elif recurse and entry.is_dir():
+                    stack.append(entry.path)
+
+
 def expand_paths(path_expr):
     """
     Gets all files of subdirectories of given path expression
     """
-    path = Path(path_expr).expanduser()
-    return Path(path.root).glob(
-        str(Path("").joinpath(*path.parts[1:] if path.is_absolute() else path.parts))
-    )
+    path_expr = os.path.expanduser(path_expr)
+
+    # A trailing ** only matches directories (as with Path.glob), which are then searched
+    # for TXT files
+    if os.path.basename(path_expr) == "**":
+        path_expr = os.path.join(path_expr, "")
+
+    # Only the matches themselves become Path objects
+    paths = map(Path, glob.iglob(path_expr, recursive=True))
+
+    # glob includes the directory a ** starts from, except for the current directory
+    # when the pattern itself starts with **, so add that back as Path.glob did
+    if path_expr == os.path.join("**", ""):
+        paths = chain([Path(".")], paths)
+    return paths
+
+
+def bounded_int(minimum):
+    """
+    Returns an argparse type that accepts integers no smaller than minimum
+    """
+    def parse(value):
+        number = int(value)
+        if number < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}, got {number}")
+        return number
+
+    # argparse names the type in its message for values that aren't numbers at all
+    parse.__name__ = "int"
+    return parse
 
 
 def main():
@@ -586,7 +1087,9 @@ def main():
         nargs="+",
         required=True,
         help="TXT file or directory of TXT files (*.{txt, TXT}) to parse recursively"
-             "(multiple arguments can be passed",
+             " (multiple arguments can be passed). Glob patterns are expanded: wildcards skip"
+             " names starting with '.', and a trailing ** matches only directories, including"
+             " the one it starts from",
     )
 
     arg_parser.add_argument(
@@ -621,6 +1124,25 @@ def main():
         help="output csv files (one per table, default) or a sqlite database",
     )
 
+    arg_parser.add_argument(
+        '-w',
+        "--workers",
+        action="store",
+        type=bounded_int(1),
+        default=1,
+        help="number of processes used to parse TXT files (default 1, no parallelism)",
+    )
+
+    arg_parser.add_argument(
+        "--max-buffer-rows",
+        action="store",
+        type=bounded_int(0),
+        default=FLUSH_THRESHOLD,
+        help="number of records held in memory before they are written partway through a file "
+             f"(default {FLUSH_THRESHOLD}; 0 writes each file in one go). With --workers, each "
+             "file is written once it has been parsed",
+    )
+
     arg_parser.add_argument(
         "--clean",
         action="store_true",
@@ -0,0 +1,144 @@
+import csv
+import logging
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from patent_txt_to_csv import PatentTxtToTabular, expand_paths, find_txt_files
+
+CONFIG = """\
+PATN:
+  <entity>: patent
+  <primary_key>: WKU
+  <fields>:
+    WKU: document_number
+    TTL: title
+
+CLMS:
+  <entity>: claim
+  <fields>:
+    "PA[A-Z1-9]":
+      <fieldname>: claim_text
+      <joiner>: "\\n"
+      <splitter>: "NUM"
+    NUM: claim_number
+"""
+
+DOC = [
+    "PATN",
+    "WKU  000000001",
+    "TTL  First patent",
+    "CLMS",
+    "NUM  1.",
+    "PAR  first claim",
+    "     continued",
+    "NUM  2.",
+    "PAR  second claim",
+    "PATN",
+    "WKU  000000002",
+    "TTL  Second patent",
+    "CLMS",
+    "NUM  1.",
+    "PA1  only claim",
+]
+
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        (self.tmp / "config.yaml").write_text(CONFIG)
+
+    def convert(self, data):
+        """
+        Writes data to a TXT file, converts it to CSV and returns the rows of each table
+        """
+        (self.tmp / "in").mkdir()
+        (self.tmp / "in" / "input.txt").write_bytes(data)
+
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.CRITICAL)
+        convertor = PatentTxtToTabular(
+            txt_input=[str(self.tmp / "in")],
+            config=self.tmp / "config.yaml",
+            output_path=self.tmp / "out",
+            output_type="csv",
+            logger=logger,
+            clean=False,
+            joiner="|#|",
+            recurse=False,
+        )
+        convertor.convert()
+
+        tables = {}
+        for path in (self.tmp / "out").glob("*.csv"):
+            with open(path, newline="", encoding="utf-8") as csv_file:
+                tables[path.stem] = list(csv.DictReader(csv_file))
+        return tables
+
+    def assert_claims(self, tables):
+        self.assertEqual(
+            [(row["patent_id"], row["claim_number"], row["claim_text"]) for row in tables["claim"]],
+            [
+                ("000000001", "1.", "first claim continued"),
+                ("000000001", "2.", "second claim"),
+                ("000000002", "1.", "only claim"),
+            ],
+        )
+
+    def test_splitter_header_that_is_also_an_entry(self):
+        # The NUM line both starts a new claim and sets that claim's number
+        tables = self.convert("\n".join(["HHHHHT APS1"] + DOC + [""]).encode())
+        self.assert_claims(tables)
+        self.assertEqual([row["title"] for row in tables["patent"]], ["First patent", "Second patent"])
+
+    def test_crlf_line_endings(self):
+        self.assert_claims(self.convert("\r\n".join(["HHHHHT APS1"] + DOC + [""]).encode()))
+
+    def test_bare_cr_line_endings(self):
+        # Files with only "\r" line endings are split into the same documents
+        tables = self.convert("\r".join(["HHHHHT APS1"] + DOC + [""]).encode())
+        self.assert_claims(tables)
+        self.assertEqual([row["title"] for row in tables["patent"]], ["First patent", "Second patent"])
+
+
+class ExpandPathsTest(unittest.TestCase):
+    def test_bare_double_star_includes_current_directory(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        (Path(tmp.name) / "sub").mkdir()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp.name)
+
+        self.assertEqual(sorted(expand_paths("**")), [Path("."), Path("sub")])
+        self.assertEqual(sorted(expand_paths("sub/**")), [Path("sub")])
+
+
+class FindTxtFilesTest(unittest.TestCase):
+    def test_follows_symlinked_directories_once(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name) / "root"
+        (root / "sub").mkdir(parents=True)
+        (root / "top.txt").touch()
+        (root / "sub" / "nested.TXT").touch()
+        target = Path(tmp.name) / "elsewhere"
+        target.mkdir()
+        (target / "linked.txt").touch()
+        try:
+            (root / "link").symlink_to(target, target_is_directory=True)
+            (root / "sub" / "loop").symlink_to(root, target_is_directory=True)
+        except (OSError, NotImplementedError):
+            self.skipTest("symlinks are not supported here")
+
+        self.assertEqual(
+            sorted(path.relative_to(root) for path in find_txt_files(root, recurse=True)),
+            [Path("link/linked.txt"), Path("sub/nested.TXT"), Path("top.txt")],
+        )
+        self.assertEqual(list(find_txt_files(root)), [root / "top.txt"])
+
+
+if __name__ == "__main__":
+    unittest.main()